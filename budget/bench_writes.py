@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+"""
+Compare sustained insert throughput of per-request commits against the
+group-commit BatchWriter, with several threads writing concurrently.
+
+    python3 bench_writes.py [--threads 32] [--rows 100] [--batch-size 64]
+                            [--delay-ms 5]
+"""
+
+import argparse
+import os.path
+import sqlite3
+import tempfile
+import threading
+import time
+
+from yoyo import read_migrations, get_backend
+
+import budget
+from writer import BatchWriter
+
+
+def setup_db(path):
+    backend = get_backend("sqlite:///%s" % path)
+    migrations = read_migrations(os.path.join(budget.script_dir, 'migrations'))
+    backend.apply_migrations(backend.to_apply(migrations))
+
+
+def run_threads(num_threads, rows, write_one):
+    def worker(n):
+        db = budget.get_db_connection()
+        for i in range(rows):
+            write_one(db, "bench-%d-%d" % (n, i))
+        db.close()
+
+    threads = [threading.Thread(target=worker, args=(n,))
+               for n in range(num_threads)]
+
+    start = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return time.perf_counter() - start
+
+
+def direct_write(db, name):
+    # Mirrors budget.add_transaction(), retrying on the write lock the way a
+    # busy server would see it surface.
+    while True:
+        try:
+            budget.add_transaction(db, 1, name)
+            return
+        except sqlite3.OperationalError:
+            time.sleep(0.001)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument('--threads', type=int, default=32)
+    parser.add_argument('--rows', type=int, default=100,
+                        help='rows written per thread')
+    parser.add_argument('--batch-size', type=int,
+                        default=budget.DEFAULT_WRITE_BATCH_SIZE)
+    parser.add_argument('--delay-ms', type=float,
+                        default=budget.DEFAULT_WRITE_BATCH_DELAY_MS)
+    args = parser.parse_args()
+
+    total = args.threads * args.rows
+
+    with tempfile.TemporaryDirectory() as tmp:
+        budget.db_path = os.path.join(tmp, "direct.db")
+        setup_db(budget.db_path)
+        elapsed = run_threads(args.threads, args.rows, direct_write)
+        print("direct commits: %d rows in %.2fs (%.0f rows/s)" %
+              (total, elapsed, total / elapsed))
+
+        budget.db_path = os.path.join(tmp, "batched.db")
+        setup_db(budget.db_path)
+        writer = BatchWriter(args.batch_size, args.delay_ms)
+        elapsed = run_threads(
+            args.threads, args.rows,
+            lambda db, name: writer.add_transaction(db, 1, name))
+        print("group commits:  %d rows in %.2fs (%.0f rows/s)" %
+              (total, elapsed, total / elapsed))
+
+
+if __name__ == "__main__":
+    main()
@@ -3,12 +3,16 @@
 import argparse
 import babel.dates
 import babel.numbers
+import collections
 import datetime
 import dateutil.parser
+import gzip
 import json
+import logging
 import math
 import os.path
 import sqlite3
+import threading
 from tabulate import tabulate
 from yoyo import read_migrations, get_backend
 
@@ -18,12 +22,37 @@ home_path = os.path.expanduser('~')
 
 db_path = os.path.join(home_path, "cdbudget.db")
 settings_path = os.path.join(home_path, "cdbudget.config.json")
+archive_path = os.path.join(home_path, "cdbudget.archive.db")
 db = None
 
 take_home_salary = None
 start_date = None
 end_date = None
 
+# Group-commit knobs for web writes, see writer.py. A longer delay or larger
+# batch trades per-request latency for more inserts per commit.
+DEFAULT_WRITE_BATCH_SIZE = 64
+DEFAULT_WRITE_BATCH_DELAY_MS = 5
+write_batch_size = DEFAULT_WRITE_BATCH_SIZE
+write_batch_delay_ms = DEFAULT_WRITE_BATCH_DELAY_MS
+
+# The loaded settings and the values derived from them, refreshed by
+# load_settings() when the settings file changes or the day rolls over. The
+# whole tuple is swapped in one assignment, so a reader that takes a local
+# reference always sees values from the same load.
+Settings = collections.namedtuple("Settings", [
+    "take_home_salary", "start_date", "end_date", "write_batch_size",
+    "write_batch_delay_ms", "num_months", "total_days", "daily_gain",
+    "passed_days", "percent_passed", "mtime", "derived_date"
+])
+current_settings = None
+settings_lock = threading.Lock()
+
+# What a bad or half-written settings file can raise while being loaded.
+SETTINGS_ERRORS = (OSError, ValueError, KeyError, TypeError, ArithmeticError)
+
+logger = logging.getLogger(__name__)
+
 
 class NotFoundError(Exception):
     pass
@@ -54,6 +83,9 @@ def main():
     def cpg(sub, sub_alias):
         return args.prog_sub == sub or args.prog_sub == sub_alias
 
+    if getattr(args, "archive", None) is not None:
+        set_archive_path(args.archive)
+
     if cpg("add", "a"):
         add_transaction(
             args.cost,
@@ -62,7 +94,7 @@ def main():
             args.fixed,
             args.mark)
     elif cpg("list", "l"):
-        list_transactions(args.marked)
+        print_transactions(args.marked, args.archived)
     elif cpg("update", "u"):
         update_transaction(
             args.name,
@@ -87,22 +119,119 @@ def main():
             list_fixed_expenses()
     elif cpg("totals", "t"):
         print_totals()
+    elif args.prog_sub == "archive":
+        before = dateutil.parser.parse(args.before).date()
+        num_archived = archive_transactions(db, before)
+        print("Archived %d transactions before %s" % (num_archived, before))
     else:
         print_dashboard()
 
 
 def load_settings():
-    global take_home_salary, start_date, end_date
+    """ Load settings, only re-reading the file when its mtime changes.
 
+    Cheap enough to call on every request: a stat of the settings file, plus
+    recomputing the derived values at most once per day.
+
+    If the file cannot be read or parsed, the error is logged and the last
+    good settings stay in use until the file changes again. Only a first
+    load, with nothing to fall back on, raises.
+    """
+    try:
+        mtime = os.stat(settings_path).st_mtime_ns
+    except OSError:
+        if current_settings is None:
+            raise
+        mtime = None
+
+    today = datetime.date.today()
+
+    current = current_settings
+    if current is not None and current.mtime == mtime and \
+            current.derived_date == today:
+        return current
+
+    with settings_lock:
+        current = current_settings
+        if current is None or current.mtime != mtime:
+            try:
+                current = _with_derived(_read_settings(mtime), today)
+            except SETTINGS_ERRORS:
+                if current is None:
+                    raise
+                logger.exception(
+                    "Could not load %s, keeping the last good settings",
+                    settings_path)
+                # Remember the bad mtime so it is not retried every call.
+                current = current._replace(mtime=mtime)
+
+        current = _with_derived(current, today)
+        _publish_settings(current)
+
+    return current
+
+
+def _read_settings(mtime):
     with open(settings_path, "r") as f:
         settings = json.load(f)
 
     take_home_salary_annual = settings["salary"]
-    start_date = dateutil.parser.parse(settings["start_date"]).date()
-    end_date = dateutil.parser.parse(settings["end_date"]).date()
+    start = dateutil.parser.parse(settings["start_date"]).date()
+    end = dateutil.parser.parse(settings["end_date"]).date()
+
+    days = (end - start).days
+
+    return Settings(
+        take_home_salary=(days / 365) * take_home_salary_annual,
+        start_date=start,
+        end_date=end,
+        write_batch_size=_positive_setting(
+            settings, "write_batch_size", DEFAULT_WRITE_BATCH_SIZE, int),
+        write_batch_delay_ms=_positive_setting(
+            settings, "write_batch_delay_ms", DEFAULT_WRITE_BATCH_DELAY_MS,
+            float),
+        num_months=None,
+        total_days=None,
+        daily_gain=None,
+        passed_days=None,
+        percent_passed=None,
+        mtime=mtime,
+        derived_date=None)
+
+
+def _positive_setting(settings, key, default, cast):
+    """ Return settings[key] as a positive number, or default if invalid. """
+    try:
+        value = cast(settings.get(key, default))
+    except (TypeError, ValueError):
+        return default
+
+    return value if value > 0 else default
 
-    total_days = (end_date - start_date).days
-    take_home_salary = (total_days / 365) * take_home_salary_annual
+
+def _with_derived(s, today):
+    total_days = (s.end_date - s.start_date).days
+    passed_days = (today - s.start_date).days
+
+    return s._replace(
+        num_months=total_days / 30,
+        total_days=total_days,
+        daily_gain=round((1 / total_days) * 100, 2),
+        passed_days=passed_days,
+        percent_passed=round((passed_days / total_days) * 100, 2),
+        derived_date=today)
+
+
+def _publish_settings(s):
+    global current_settings, take_home_salary, start_date, end_date
+    global write_batch_size, write_batch_delay_ms
+
+    take_home_salary = s.take_home_salary
+    start_date = s.start_date
+    end_date = s.end_date
+    write_batch_size = s.write_batch_size
+    write_batch_delay_ms = s.write_batch_delay_ms
+    current_settings = s
 
 
 def print_dashboard():
@@ -118,30 +247,30 @@ def print_dashboard():
 def print_totals():
     t = get_totals(db)
 
-    print("Salary for Period: %s" % fmtdlr(take_home_salary))
+    print("Salary for Period: %s" % fmtdlr(t["take_home_salary"]))
     print("Total Days: %d" % t["total_days"])
     print("Total Spent: \033[1m%s\033[0m (%s)" %
           (fmtdlr(t["sum_spent"]), t["percent_spent"]))
     print(
         "Total Unallocated: %s" %
         fmtdlr(
-            take_home_salary -
+            t["take_home_salary"] -
             t["allocated_per_period"]))
     print("Days Passed: %s (%.1f%%) (%.1f%% months)" % (t["passed_days"], t["percent_passed"], t["num_months"]))
 
 
 def get_totals(db):
-    num_months = (end_date - start_date).days / 30
+    s = current_settings
 
     curs = db.cursor()
-    sql = "SELECT COALESCE(SUM(cost), 0) FROM transactions"
+    sql = "SELECT COALESCE(SUM(cost), 0) FROM spending"
     sum_spent = curs.execute(sql).fetchone()[0]
 
     sql = """
         SELECT
             COALESCE(SUM(m.cost_per_item * m.num_items_per_month * %d), 0)
         FROM monthly_expenses m
-    """ % num_months
+    """ % s.num_months
     monthly_allocated_per_period = curs.execute(sql).fetchone()[0]
 
     sql = """
@@ -150,28 +279,24 @@ def get_totals(db):
     fixed_allocated_per_period = curs.execute(sql).fetchone()[0]
     curs.close()
 
-    (total_days, passed_days, daily_gain, percent_passed) = get_time_passed()
-
-    percent_spent = percent_of(sum_spent, take_home_salary)
+    percent_spent = percent_of(sum_spent, s.take_home_salary)
 
     return {
-        'num_months': num_months,
+        'take_home_salary': s.take_home_salary,
+        'num_months': s.num_months,
         'sum_spent': sum_spent,
-        'total_days': total_days,
-        'passed_days': passed_days,
-        'daily_gain': daily_gain,
-        'percent_passed': percent_passed,
+        'total_days': s.total_days,
+        'passed_days': s.passed_days,
+        'daily_gain': s.daily_gain,
+        'percent_passed': s.percent_passed,
         'percent_spent': percent_spent,
         'allocated_per_period': monthly_allocated_per_period + fixed_allocated_per_period
     }
 
 
 def get_time_passed():
-    total_days = (end_date - start_date).days
-    passed_days = (datetime.date.today() - start_date).days
-    daily_gain = round((1 / total_days) * 100, 2)
-    percent_passed = round((passed_days / total_days) * 100, 2)
-    return (total_days, passed_days, daily_gain, percent_passed)
+    s = current_settings
+    return (s.total_days, s.passed_days, s.daily_gain, s.percent_passed)
 
 
 def get_argparser():
@@ -246,6 +371,14 @@ def get_argparser():
         '--marked',
         action='store_true',
         help='only list marked')
+    list_sub.add_argument(
+        '-a',
+        '--archived',
+        action='store_true',
+        help='include archived transactions')
+    list_sub.add_argument(
+        '--archive',
+        help='path to the archive file to read from')
 
     monthly_sub = subs.add_parser(
         'monthly',
@@ -271,6 +404,18 @@ def get_argparser():
 
     subs.add_parser('totals', help='print totals', aliases=['t'])
 
+    archive_sub = subs.add_parser(
+        'archive',
+        help='move old transactions into the archive file')
+    archive_sub.add_argument(
+        '--before',
+        required=True,
+        help='archive transactions made before this date')
+    archive_sub.add_argument(
+        '--archive',
+        help='path to the archive file; a .ndjson.gz suffix writes '
+        'compressed NDJSON instead of SQLite')
+
     return parser
 
 
@@ -281,7 +426,36 @@ def add_transaction(
         monthly_id=None,
         fixed_id=None,
         marked=False):
+    params = prepare_transaction(
+        db, cost, name, monthly_id, fixed_id, marked)
+    if params is None:
+        return
+
     curs = db.cursor()
+    curs.execute(INSERT_TRANSACTION_SQL, params)
+
+    db.commit()
+    curs.close()
+
+
+INSERT_TRANSACTION_SQL = """
+    INSERT INTO transactions (name, cost, monthly_expense_id, fixed_expense_id, time, marked)
+    VALUES (?, ?, ?, ?, ?, ?)
+"""
+
+
+def prepare_transaction(
+        db,
+        cost,
+        name=None,
+        monthly_id=None,
+        fixed_id=None,
+        marked=False):
+    """ Resolve categories and return the INSERT_TRANSACTION_SQL params.
+
+    Returns None if no name was given and none could be derived.
+    """
+    empty_name = None
 
     if monthly_id is not None:
         (monthly_id, empty_name) = get_monthly_id(monthly_id, db)
@@ -291,19 +465,11 @@ def add_transaction(
     if name is None:
         if empty_name is None:
             print("Please provide a name, or something to derive a useful name from!")
-            return
+            return None
 
         name = empty_name + '-' + str(datetime.date.today())
 
-    sql = """
-        INSERT INTO transactions (name, cost, monthly_expense_id, fixed_expense_id, time, marked)
-        VALUES (?, ?, ?, ?, ?, ?)
-    """
-    params = (name, cost, monthly_id, fixed_id, datetime.datetime.now(), marked)
-    curs.execute(sql, params)
-
-    db.commit()
-    curs.close()
+    return (name, cost, monthly_id, fixed_id, datetime.datetime.now(), marked)
 
 
 def update_transaction(
@@ -359,9 +525,20 @@ def update_transaction(
     curs.close()
 
 
-def list_transactions(db, count=25, marked=False):
+def list_transactions(db, count=25, marked=False, archived=False):
     curs = db.cursor()
 
+    archive_table = attach_archive(db) if archived else None
+    if archive_table is not None:
+        cols = ", ".join(TRANSACTION_COLUMNS)
+        table = """(
+            SELECT %s FROM transactions
+            UNION ALL
+            SELECT %s FROM %s WHERE id NOT IN (SELECT id FROM main.transactions)
+        )""" % (cols, cols, archive_table)
+    else:
+        table = "transactions"
+
     if marked:
         where = "WHERE marked=1"
     else:
@@ -374,13 +551,13 @@ def list_transactions(db, count=25, marked=False):
 
     sql = """
         SELECT t.id, t.name, t.cost, m.name as monthly_name, f.name as fixed_name, t.time, t.marked
-        FROM transactions t
+        FROM %s t
         LEFT JOIN monthly_expenses m ON m.id = t.monthly_expense_id
         LEFT JOIN fixed_expenses f ON f.id = t.fixed_expense_id
         %s
         ORDER BY time DESC
         %s
-    """ % (where, limit)
+    """ % (table, where, limit)
     res = curs.execute(sql)
 
     rows = res.fetchall()
@@ -408,8 +585,11 @@ def list_transactions(db, count=25, marked=False):
     return table_data
 
 
-def print_transactions():
-    table_data = list_transactions(db)
+def print_transactions(marked=False, archived=False):
+    table_data = [
+        [d["name"], d["cost_fmt"], d["category"], d["time"]]
+        for d in list_transactions(db, marked=marked, archived=archived)
+    ]
 
     headers = ['Name', 'Cost', 'Category', 'Time']
     if len(table_data) > 0:
@@ -487,7 +667,7 @@ def list_monthly_expenses(db):
             (cost_per_item * num_items_per_month * 12) as total_per_year,
             COALESCE(SUM(t.cost), 0) as spent
         FROM monthly_expenses m
-        LEFT JOIN transactions t ON t.monthly_expense_id = m.id
+        LEFT JOIN spending t ON t.monthly_expense_id = m.id
         GROUP BY m.id
         ORDER BY total_per_year DESC
     """
@@ -503,7 +683,8 @@ def list_monthly_expenses(db):
 
         d = dict(row)
         d["total_per_period"] = totals["num_months"] * total_per_month
-        d["percent_income"] = percent_of(total_per_year, take_home_salary)
+        d["percent_income"] = percent_of(
+            total_per_year, totals["take_home_salary"])
 
         percent_spent = ((spent or 0) / total_per_year) * 100
         cut_days = (percent_spent - totals["percent_passed"]) / totals["daily_gain"]
@@ -556,7 +737,7 @@ def list_fixed_expenses(db):
     sql = """
         SELECT f.id, f.name, f.cost as fixed_cost, SUM(t.cost) as spent
         FROM fixed_expenses f
-        LEFT JOIN transactions t ON t.fixed_expense_id = f.id
+        LEFT JOIN spending t ON t.fixed_expense_id = f.id
         GROUP BY f.id
         ORDER BY f.cost DESC
     """
@@ -610,5 +791,158 @@ def create_fixed_category(name, cost):
     curs.close()
 
 
+TRANSACTION_COLUMNS = (
+    "id", "name", "monthly_expense_id", "fixed_expense_id", "cost", "time",
+    "marked")
+
+ARCHIVE_TABLE_SQL = """
+    CREATE TABLE IF NOT EXISTS %s (
+        id INTEGER PRIMARY KEY,
+        name TEXT,
+        monthly_expense_id INT,
+        fixed_expense_id INT,
+        cost INTEGER NOT NULL,
+        time DATETIME,
+        marked INT DEFAULT 0
+    )
+"""
+
+
+def set_archive_path(path):
+    global archive_path
+    archive_path = path
+
+
+def is_ndjson_archive():
+    return archive_path.endswith(".ndjson.gz")
+
+
+def attach_archive(db, create=False):
+    """ Make the archive queryable through db and return its table name.
+
+    SQLite archives are attached as "archive"; compressed NDJSON archives are
+    loaded into a temporary table. Returns None if there is no archive yet,
+    unless create is set, which only archive_transactions() does.
+    """
+    if not create and not os.path.exists(archive_path):
+        return None
+
+    # ATTACH is not allowed inside a transaction.
+    db.commit()
+
+    if is_ndjson_archive():
+        table = "temp.archived_transactions"
+        db.execute(ARCHIVE_TABLE_SQL % table)
+        db.execute("DELETE FROM %s" % table)
+
+        sql = "INSERT OR REPLACE INTO %s (%s) VALUES (%s)" % (
+            table, ", ".join(TRANSACTION_COLUMNS),
+            ", ".join("?" * len(TRANSACTION_COLUMNS)))
+        with gzip.open(archive_path, "rt") as f:
+            rows = (json.loads(line) for line in f if line.strip())
+            db.executemany(
+                sql, ([r[c] for c in TRANSACTION_COLUMNS] for r in rows))
+
+        db.commit()
+        return table
+
+    attached = [row[1] for row in db.execute("PRAGMA database_list")]
+    if "archive" not in attached:
+        db.execute("ATTACH DATABASE ? AS archive", (archive_path,))
+
+    table = "archive.transactions"
+    if create:
+        db.execute(ARCHIVE_TABLE_SQL % table)
+    return table
+
+
+def detach_archive(db):
+    attached = [row[1] for row in db.execute("PRAGMA database_list")]
+    if "archive" in attached:
+        db.execute("DETACH DATABASE archive")
+
+
+def _append_ndjson_archive(rows):
+    """ Append rows to the NDJSON archive as one gzip member.
+
+    On failure the file is truncated back to its previous size, so a partly
+    written member never corrupts the archive.
+    """
+    with open(archive_path, "ab") as raw:
+        size = os.fstat(raw.fileno()).st_size
+        try:
+            with gzip.open(raw, "wt") as f:
+                for row in rows:
+                    f.write(json.dumps(dict(row)) + "\n")
+            raw.flush()
+            os.fsync(raw.fileno())
+        except BaseException:
+            raw.truncate(size)
+            raise
+
+
+def archive_transactions(db, before):
+    """ Move transactions made before the given date into the archive.
+
+    Per-category, per-day summary rows are left behind so totals stay the
+    same, then the hot database is vacuumed and analyzed. Returns the number
+    of transactions archived.
+    """
+    before = str(before)
+    cols = ", ".join(TRANSACTION_COLUMNS)
+
+    curs = db.cursor()
+    sql = "SELECT COUNT(*) FROM transactions WHERE time < ?"
+    num_archived = curs.execute(sql, (before,)).fetchone()[0]
+    if num_archived == 0:
+        curs.close()
+        return 0
+
+    # Rows are copied to the archive before they are deleted here. If the
+    # delete then fails, they are in both places until a retry. Ids are never
+    # reused, so readers drop the duplicates by id.
+    try:
+        if is_ndjson_archive():
+            sql = "SELECT %s FROM transactions WHERE time < ? ORDER BY id" % \
+                cols
+            _append_ndjson_archive(curs.execute(sql, (before,)))
+        else:
+            table = attach_archive(db, create=True)
+            sql = """
+                INSERT OR REPLACE INTO %s (%s)
+                SELECT %s FROM main.transactions WHERE time < ?
+            """ % (table, cols, cols)
+            curs.execute(sql, (before,))
+
+        sql = """
+            INSERT INTO transaction_summaries (
+                day, monthly_expense_id, fixed_expense_id, cost,
+                num_transactions
+            )
+            SELECT date(time), monthly_expense_id, fixed_expense_id,
+                SUM(cost), COUNT(*)
+            FROM main.transactions
+            WHERE time < ?
+            GROUP BY date(time), monthly_expense_id, fixed_expense_id
+        """
+        curs.execute(sql, (before,))
+
+        sql = "DELETE FROM main.transactions WHERE time < ?"
+        curs.execute(sql, (before,))
+
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+    finally:
+        curs.close()
+
+    detach_archive(db)
+    db.execute("VACUUM")
+    db.execute("ANALYZE")
+
+    return num_archived
+
+
 if __name__ == "__main__":
     main()
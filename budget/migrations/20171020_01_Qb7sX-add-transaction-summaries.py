@@ -0,0 +1,32 @@
+"""
+Add transaction summaries for archived transactions
+"""
+
+from yoyo import step
+
+__depends__ = {'20170915_01_Kvwvm-add'}
+
+steps = [
+    step("""
+        CREATE TABLE transaction_summaries (
+            id INTEGER PRIMARY KEY,
+            day DATE NOT NULL,
+            monthly_expense_id INT REFERENCES monthly_expenses(id),
+            fixed_expense_id INT REFERENCES fixed_expenses(id),
+            cost INTEGER NOT NULL,
+            num_transactions INTEGER NOT NULL
+        )
+        """,
+        "DROP TABLE transaction_summaries"
+    ),
+    step("""
+        CREATE VIEW spending AS
+            SELECT monthly_expense_id, fixed_expense_id, cost
+            FROM transactions
+            UNION ALL
+            SELECT monthly_expense_id, fixed_expense_id, cost
+            FROM transaction_summaries
+        """,
+        "DROP VIEW spending"
+    )
+]
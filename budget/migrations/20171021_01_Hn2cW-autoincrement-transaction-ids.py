@@ -0,0 +1,56 @@
+"""
+Never reuse transaction ids, so they stay unique across the archive
+"""
+
+from yoyo import step
+
+__depends__ = {'20171020_01_Qb7sX-add-transaction-summaries'}
+
+SPENDING_VIEW = """
+    CREATE VIEW spending AS
+        SELECT monthly_expense_id, fixed_expense_id, cost
+        FROM transactions
+        UNION ALL
+        SELECT monthly_expense_id, fixed_expense_id, cost
+        FROM transaction_summaries
+"""
+
+
+def rebuild_transactions(autoincrement):
+    statements = [
+        "DROP VIEW spending",
+        """
+        CREATE TABLE transactions_new (
+            id INTEGER PRIMARY KEY %s,
+            name TEXT,
+            monthly_expense_id INT REFERENCES monthly_expenses(id),
+            fixed_expense_id INT REFERENCES fixed_expenses(id),
+            cost INTEGER NOT NULL,
+            time DATETIME,
+            marked INT DEFAULT 0
+        )
+        """ % ("AUTOINCREMENT" if autoincrement else ""),
+        """
+        INSERT INTO transactions_new (
+            id, name, monthly_expense_id, fixed_expense_id, cost, time, marked
+        )
+        SELECT id, name, monthly_expense_id, fixed_expense_id, cost, time,
+            marked
+        FROM transactions
+        """,
+        "DROP TABLE transactions",
+        "ALTER TABLE transactions_new RENAME TO transactions",
+        SPENDING_VIEW
+    ]
+
+    def apply(conn):
+        cursor = conn.cursor()
+        for sql in statements:
+            cursor.execute(sql)
+
+    return apply
+
+
+steps = [
+    step(rebuild_transactions(True), rebuild_transactions(False))
+]
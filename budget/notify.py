@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+
+import os
+import threading
+import time
+
+import budget
+
+
+class ChangeFeed:
+    """ Process-local change counter that listeners can block on.
+
+    A watcher thread polls SQLite's data_version on its own connection,
+    which changes on any commit from another connection: the BatchWriter in
+    this process, other uWSGI workers or the CLI. Writers therefore need not
+    call notify() themselves, which would count each write twice.
+    """
+
+    def __init__(self, poll_interval=0.1):
+        self.poll_interval = poll_interval
+        self.version = 0
+        self._cond = threading.Condition()
+        self._pid = None
+
+    def notify(self):
+        with self._cond:
+            self.version += 1
+            self._cond.notify_all()
+
+    def wait(self, version, timeout=None):
+        """ Block until the version moves past the given one, or timeout.
+
+        Returns the current version.
+        """
+        self.start()
+
+        with self._cond:
+            self._cond.wait_for(lambda: self.version != version, timeout)
+            return self.version
+
+    def start(self):
+        """ Start watching, if not already, once per process.
+
+        Returns after the watcher has taken its first reading, so any commit
+        made after start() returns is seen as a change. Call this before
+        reading the state that changes are to be compared against.
+        """
+        # Started lazily, and again after a fork, for the same reason as
+        # the BatchWriter thread.
+        if self._pid == os.getpid():
+            return
+
+        with self._cond:
+            if self._pid == os.getpid():
+                return
+
+            ready = threading.Event()
+            thread = threading.Thread(
+                target=self._watch, args=(ready,),
+                name="budget-change-feed", daemon=True)
+            thread.start()
+            ready.wait()
+            self._pid = os.getpid()
+
+    def _watch(self, ready):
+        try:
+            db = budget.get_db_connection()
+            last = db.execute("PRAGMA data_version").fetchone()[0]
+        finally:
+            ready.set()
+
+        while True:
+            time.sleep(self.poll_interval)
+
+            data_version = db.execute("PRAGMA data_version").fetchone()[0]
+            if data_version != last:
+                self.notify()
+            last = data_version
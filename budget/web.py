@@ -1,9 +1,36 @@
 #!/usr/bin/env python3
 
-from flask import Flask, render_template, g, request, redirect, url_for
+import json
+import threading
+import time
+
+from flask import (Flask, Response, render_template, g, request, redirect,
+                   url_for)
 
 import budget
 from budget import fmtdlr
+from notify import ChangeFeed
+from writer import BatchWriter
+
+# Dashboard values that change with writes, pushed by /events.
+LIVE_TOTALS = [
+    "sum_spent", "percent_spent", "total_unallocated", "passed_days",
+    "percent_passed"
+]
+LIVE_MONTHLY = ["spent_fmt", "percent_spent", "cut", "cut_class"]
+LIVE_FIXED = ["spent_fmt"]
+LIVE_TRANSACTIONS = ["name", "category", "cost_fmt"]
+
+EVENTS_KEEPALIVE = 15
+
+# Each /events stream holds a server thread while it is open. Streams are
+# capped per process (EVENTS_MAX_STREAMS in the app config) and closed after
+# EVENTS_MAX_AGE seconds, so open dashboards cannot starve the form posts.
+# Browsers reconnect on their own after the advertised retry delay.
+EVENTS_MAX_STREAMS = 4
+EVENTS_MAX_AGE = 300
+EVENTS_RETRY_MS = 1000
+EVENTS_BUSY_RETRY_MS = 30000
 
 def get_db():
     if 'db' not in g:
@@ -12,25 +39,118 @@ def get_db():
     return g.db
 
 
+def get_dashboard_totals(db):
+    t = budget.get_totals(db)
+    t["sum_spent"] = fmtdlr(t["sum_spent"])
+    t["total_unallocated"] = fmtdlr(t["take_home_salary"] -
+        t["allocated_per_period"])
+    return t
+
+
+def list_monthly_expenses(db):
+    monthly_expenses = budget.list_monthly_expenses(db)
+
+    for item in monthly_expenses:
+        if item["ahead"]:
+            (item["cut_class"], cut_sym) = ("ahead", "+")
+        elif item["behind"]:
+            (item["cut_class"], cut_sym) = ("behind", "-")
+        else:
+            (item["cut_class"], cut_sym) = ("", "")
+        item["cut"] = cut_sym + item["cut_days"]
+
+    return monthly_expenses
+
+
+def get_dashboard_state(db):
+    """ The live parts of the dashboard, keyed so they can be diffed. """
+    t = get_dashboard_totals(db)
+
+    return {
+        'totals': {k: t[k] for k in LIVE_TOTALS},
+        'monthly': {
+            str(item["id"]): {k: item[k] for k in LIVE_MONTHLY}
+            for item in list_monthly_expenses(db)
+        },
+        'fixed': {
+            str(item["id"]): {k: item[k] for k in LIVE_FIXED}
+            for item in budget.list_fixed_expenses(db)
+        },
+        'transactions': [
+            [item[k] for k in LIVE_TRANSACTIONS]
+            for item in budget.list_transactions(db)
+        ]
+    }
+
+
+def diff_dashboard_state(old, new):
+    """ Return only the entries of new that differ from old.
+
+    Keyed sections are diffed per entry; lists, such as the recent
+    transactions, are sent whole whenever they change.
+    """
+    old = old or {}
+    delta = {}
+
+    for section, values in new.items():
+        if not isinstance(values, dict):
+            if old.get(section) != values:
+                delta[section] = values
+            continue
+
+        prev = old.get(section, {})
+        changed = {k: v for k, v in values.items() if prev.get(k) != v}
+        if changed:
+            delta[section] = changed
+
+    return delta
+
+
+def is_fetch():
+    return request.headers.get('X-Requested-With') == 'fetch'
+
+
 def create_app():
     app = Flask(__name__)
 
     app.logger.debug('Creating app')
+    app.config.setdefault('EVENTS_MAX_STREAMS', EVENTS_MAX_STREAMS)
     budget.load_settings()
 
+    stream_slots = threading.BoundedSemaphore(
+        app.config['EVENTS_MAX_STREAMS'])
+
+    feed = ChangeFeed()
+    writer = BatchWriter()
+
+    # Shared by every open /events stream, so a write costs one recompute
+    # per process rather than one per dashboard.
+    state_lock = threading.Lock()
+    state_cache = {'key': None, 'state': None}
+
+    def get_cached_state(db):
+        with state_lock:
+            key = (feed.version, budget.current_settings)
+            if state_cache['key'] != key:
+                state_cache['state'] = get_dashboard_state(db)
+                state_cache['key'] = key
+
+            return (key[0], state_cache['state'])
+
+    @app.before_request
+    def refresh_settings():
+        # Only re-parses the settings file when it has changed on disk.
+        budget.load_settings()
+
     @app.route('/')
     def dashboard():
         get_db()
 
-        t = budget.get_totals(g.db)
-        t["sum_spent"] = fmtdlr(t["sum_spent"])
-        t["total_unallocated"] = fmtdlr(budget.take_home_salary -
-            t["allocated_per_period"])
-
+        t = get_dashboard_totals(g.db)
         context = {
-            'take_home_salary': fmtdlr(budget.take_home_salary),
+            'take_home_salary': fmtdlr(t["take_home_salary"]),
             'totals': t,
-            'monthly_expenses': budget.list_monthly_expenses(g.db),
+            'monthly_expenses': list_monthly_expenses(g.db),
             'fixed_expenses': budget.list_fixed_expenses(g.db),
             'transactions': budget.list_transactions(g.db)
         }
@@ -44,7 +164,10 @@ def create_app():
         name = request.form.get('name')
         cost = int(request.form.get('cost'))
 
-        budget.add_transaction(g.db, cost, name, monthly_id=category)
+        writer.add_transaction(g.db, cost, name, monthly_id=category)
+
+        if is_fetch():
+            return ('', 204)
 
         redirect_url = url_for('dashboard') + "#add-m-t"
         return redirect(redirect_url)
@@ -57,17 +180,61 @@ def create_app():
         name = request.form.get('name')
         cost = int(request.form.get('cost'))
 
-        budget.add_transaction(g.db, cost, name, fixed_id=category)
+        writer.add_transaction(g.db, cost, name, fixed_id=category)
+
+        if is_fetch():
+            return ('', 204)
 
         redirect_url = url_for('dashboard') + "#add-f-t"
         return redirect(redirect_url)
 
+    @app.route('/events')
+    def events():
+        def stream():
+            if not stream_slots.acquire(blocking=False):
+                # No free slot: ask the browser to come back later and keep
+                # the page it already has.
+                yield "retry: %d\n\n" % EVENTS_BUSY_RETRY_MS
+                return
+
+            db = None
+            try:
+                yield "retry: %d\n\n" % EVENTS_RETRY_MS
+
+                db = budget.get_db_connection()
+                sent = None
+                feed.start()
+                closes_at = time.monotonic() + EVENTS_MAX_AGE
+                while time.monotonic() < closes_at:
+                    budget.load_settings()
+                    (version, state) = get_cached_state(db)
+
+                    delta = diff_dashboard_state(sent, state)
+                    if delta:
+                        yield "data: %s\n\n" % json.dumps(delta)
+                    else:
+                        yield ": keepalive\n\n"
+                    sent = state
+
+                    timeout = min(EVENTS_KEEPALIVE,
+                                  closes_at - time.monotonic())
+                    feed.wait(version, timeout=max(0, timeout))
+            finally:
+                if db is not None:
+                    db.close()
+                stream_slots.release()
+
+        headers = {'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+        return Response(stream(), mimetype='text/event-stream',
+                        headers=headers)
+
     @app.route('/transaction')
     def list_transactions():
         get_db()
 
         context = {
-            'transactions': budget.list_transactions(g.db, count=None)
+            'transactions': budget.list_transactions(
+                g.db, count=None, archived='archived' in request.args)
         }
         return render_template('transactions.html', **context)
 
@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+
+import os
+import queue
+import threading
+import time
+
+import budget
+
+
+class _PendingWrite:
+    def __init__(self, sql, params):
+        self.sql = sql
+        self.params = params
+        self.done = threading.Event()
+        self.error = None
+
+
+class BatchWriter:
+    """ Group-commit writer: one thread per process flushes queued inserts.
+
+    Requests call submit(), which blocks until their row has been committed.
+    The writer thread commits whatever is queued once batch_size rows are
+    waiting or delay_ms has passed since the first row of the batch arrived.
+    """
+
+    def __init__(self, batch_size=None, delay_ms=None):
+        self.batch_size = batch_size
+        self.delay_ms = delay_ms
+        self._queue = None
+        self._thread = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def submit(self, sql, params):
+        self._ensure_started()
+
+        pending = _PendingWrite(sql, params)
+        self._queue.put(pending)
+        pending.done.wait()
+
+        if pending.error is not None:
+            raise pending.error
+
+    def add_transaction(self, db, cost, name=None, monthly_id=None,
+                        fixed_id=None, marked=False):
+        """ Batched equivalent of budget.add_transaction(). """
+        params = budget.prepare_transaction(
+            db, cost, name, monthly_id, fixed_id, marked)
+        if params is None:
+            return
+
+        self.submit(budget.INSERT_TRANSACTION_SQL, params)
+
+    def _ensure_started(self):
+        # The thread is started lazily, and again after a fork, since
+        # pre-forking servers (uWSGI) do not carry threads into workers.
+        if self._pid == os.getpid() and self._thread.is_alive():
+            return
+
+        with self._lock:
+            if self._pid == os.getpid() and self._thread.is_alive():
+                return
+
+            # A thread that died in this process leaves its queue behind,
+            # so the replacement picks up anything already waiting.
+            if self._pid != os.getpid():
+                self._queue = queue.Queue()
+
+            self._thread = threading.Thread(
+                target=self._run, args=(self._queue,),
+                name="budget-batch-writer", daemon=True)
+            self._thread.start()
+            self._pid = os.getpid()
+
+    def _run(self, q):
+        db = None
+
+        while True:
+            batch = [q.get()]
+
+            try:
+                if db is None:
+                    db = budget.get_db_connection()
+
+                self._fill(q, batch)
+                self._flush(db, batch)
+            except Exception as e:
+                # Never leave a request waiting on a batch that failed
+                # outside of _commit().
+                for pending in batch:
+                    if not pending.done.is_set():
+                        pending.error = e
+                        pending.done.set()
+
+    def _fill(self, q, batch):
+        batch_size = self.batch_size or budget.write_batch_size
+        delay_ms = self.delay_ms
+        if delay_ms is None:
+            delay_ms = budget.write_batch_delay_ms
+
+        deadline = time.monotonic() + delay_ms / 1000
+        while len(batch) < batch_size:
+            try:
+                batch.append(
+                    q.get(timeout=max(0, deadline - time.monotonic())))
+            except queue.Empty:
+                break
+
+    def _flush(self, db, batch):
+        try:
+            self._commit(db, batch)
+        except Exception:
+            # Fall back to one commit per row so a single bad write only
+            # fails its own request.
+            for pending in batch:
+                try:
+                    self._commit(db, [pending])
+                except Exception as e:
+                    pending.error = e
+
+        for pending in batch:
+            pending.done.set()
+
+    def _commit(self, db, batch):
+        curs = db.cursor()
+        try:
+            for pending in batch:
+                curs.execute(pending.sql, pending.params)
+            db.commit()
+        except Exception:
+            db.rollback()
+            raise
+        finally:
+            curs.close()
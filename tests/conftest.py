@@ -0,0 +1,57 @@
+import json
+import os.path
+import sys
+
+import pytest
+
+# The modules in budget/ import each other as top-level modules (as they do
+# when run from that directory by uWSGI), so put it first on the path.
+budget_dir = os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), "budget")
+sys.path.insert(0, budget_dir)
+sys.modules.pop("budget", None)
+
+import budget  # noqa: E402
+from yoyo import read_migrations, get_backend  # noqa: E402
+
+SETTINGS = {
+    "salary": 52000,
+    "start_date": "1/1/2018",
+    "end_date": "12/31/2018"
+}
+
+
+def write_settings(path, **overrides):
+    settings = dict(SETTINGS, **overrides)
+    with open(path, "w") as f:
+        json.dump(settings, f)
+
+
+@pytest.fixture
+def paths(tmp_path, monkeypatch):
+    """ Point budget at a fresh, migrated database and settings file. """
+    db_path = str(tmp_path / "budget.db")
+    settings_path = str(tmp_path / "settings.json")
+
+    monkeypatch.setattr(budget, "db_path", db_path)
+    monkeypatch.setattr(budget, "settings_path", settings_path)
+    monkeypatch.setattr(budget, "archive_path",
+                        str(tmp_path / "archive.db"))
+    monkeypatch.setattr(budget, "current_settings", None)
+
+    write_settings(settings_path)
+    budget.load_settings()
+
+    backend = get_backend("sqlite:///%s" % db_path)
+    migrations = read_migrations(os.path.join(budget_dir, "migrations"))
+    backend.apply_migrations(backend.to_apply(migrations))
+
+    return tmp_path
+
+
+@pytest.fixture
+def db(paths, monkeypatch):
+    conn = budget.get_db_connection()
+    monkeypatch.setattr(budget, "db", conn)
+    yield conn
+    conn.close()
@@ -0,0 +1,181 @@
+#!/usr/bin/env python3
+"""
+Hammer the web app with mixed read/write traffic and report throughput and
+latency percentiles per route.
+
+By default the app runs in-process through Flask's test client against a
+temporary database. Pass --url to drive a running server (uWSGI behind a
+web server, or the Flask dev server) instead.
+
+    python3 tests/loadtest.py [--threads 8] [--requests 200]
+                              [--write-ratio 0.2] [--url URL]
+"""
+
+import argparse
+import collections
+import os.path
+import random
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+import urllib.request
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import conftest  # noqa: E402,F401  (puts budget/ on the path)
+
+import budget  # noqa: E402
+
+READS = ["/", "/transaction"]
+WRITES = ["/transaction/monthly/add", "/transaction/fixed/add"]
+
+
+def setup_app(tmp):
+    from yoyo import read_migrations, get_backend
+    import web
+
+    budget.db_path = os.path.join(tmp, "budget.db")
+    budget.settings_path = os.path.join(tmp, "settings.json")
+    budget.archive_path = os.path.join(tmp, "archive.db")
+    conftest.write_settings(budget.settings_path)
+
+    backend = get_backend("sqlite:///%s" % budget.db_path)
+    migrations = read_migrations(
+        os.path.join(conftest.budget_dir, "migrations"))
+    backend.apply_migrations(backend.to_apply(migrations))
+
+    budget.load_settings()
+    budget.db = budget.get_db_connection()
+    for i in range(10):
+        budget.create_monthly_category("monthly%d" % i, 10 + i, 4)
+        budget.create_fixed_category("fixed%d" % i, 500 + i)
+
+    app = web.create_app()
+    app.config["TESTING"] = True
+    return app
+
+
+def client_requester(app):
+    local = threading.local()
+
+    def request(path, data):
+        if not hasattr(local, "client"):
+            local.client = app.test_client()
+
+        if data is None:
+            resp = local.client.get(path)
+        else:
+            resp = local.client.post(
+                path, data=data, headers={"X-Requested-With": "fetch"})
+        if resp.status_code >= 400:
+            raise RuntimeError("%s returned %d" % (path, resp.status_code))
+
+    return request
+
+
+def url_requester(base_url):
+    def request(path, data):
+        body = None
+        if data is not None:
+            body = urllib.parse.urlencode(data).encode()
+
+        req = urllib.request.Request(
+            base_url.rstrip("/") + path, data=body,
+            headers={"X-Requested-With": "fetch"})
+        with urllib.request.urlopen(req) as resp:
+            resp.read()
+
+    return request
+
+
+def percentile(sorted_values, p):
+    index = min(len(sorted_values) - 1,
+                int(round(p / 100 * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def run(request, num_threads, num_requests, write_ratio):
+    latencies = collections.defaultdict(list)
+    errors = []
+    lock = threading.Lock()
+
+    def worker(n):
+        rng = random.Random(n)
+        for i in range(num_requests):
+            if rng.random() < write_ratio:
+                path = rng.choice(WRITES)
+                data = {"category": str(rng.randint(1, 10)),
+                        "name": "load-%d-%d" % (n, i),
+                        "cost": str(rng.randint(1, 100))}
+            else:
+                path = rng.choice(READS)
+                data = None
+
+            start = time.perf_counter()
+            try:
+                request(path, data)
+            except Exception as e:
+                with lock:
+                    errors.append(e)
+                continue
+            elapsed = time.perf_counter() - start
+
+            with lock:
+                latencies[path].append(elapsed)
+
+    threads = [threading.Thread(target=worker, args=(n,))
+               for n in range(num_threads)]
+
+    start = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - start
+
+    return (elapsed, latencies, errors)
+
+
+def report(elapsed, latencies, errors):
+    total = sum(len(v) for v in latencies.values())
+    print("%d requests in %.2fs (%.0f req/s), %d errors" %
+          (total, elapsed, total / elapsed, len(errors)))
+
+    print("%-28s %7s %9s %9s %9s %9s" %
+          ("route", "count", "p50 ms", "p95 ms", "p99 ms", "max ms"))
+    for path in sorted(latencies):
+        values = sorted(latencies[path])
+        print("%-28s %7d %9.2f %9.2f %9.2f %9.2f" % (
+            path, len(values),
+            percentile(values, 50) * 1000,
+            percentile(values, 95) * 1000,
+            percentile(values, 99) * 1000,
+            values[-1] * 1000))
+
+    if errors:
+        print("first error: %r" % errors[0])
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__.strip().split("\n")[0])
+    parser.add_argument('--threads', type=int, default=8)
+    parser.add_argument('--requests', type=int, default=200,
+                        help='requests sent per thread')
+    parser.add_argument('--write-ratio', type=float, default=0.2)
+    parser.add_argument('--url', help='base URL of a running server')
+    args = parser.parse_args()
+
+    if args.url:
+        request = url_requester(args.url)
+        report(*run(request, args.threads, args.requests, args.write_ratio))
+        return
+
+    with tempfile.TemporaryDirectory() as tmp:
+        request = client_requester(setup_app(tmp))
+        report(*run(request, args.threads, args.requests, args.write_ratio))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,292 @@
+import datetime
+import gzip
+import os
+import sqlite3
+import threading
+import time
+
+import pytest
+from hypothesis import HealthCheck, given, settings, strategies as st
+
+import budget
+from conftest import write_settings
+from writer import BatchWriter
+
+START = datetime.datetime(2018, 1, 1)
+
+monthly_st = st.lists(
+    st.tuples(st.integers(1, 500), st.integers(1, 30)), max_size=5)
+fixed_st = st.lists(st.integers(0, 5000), max_size=5)
+transactions_st = st.lists(
+    st.tuples(
+        st.integers(0, 1000),
+        st.sampled_from([None, "monthly", "fixed"]),
+        st.integers(0, 4),
+        st.integers(0, 364)),
+    max_size=40)
+
+examples = settings(
+    max_examples=50, deadline=None,
+    suppress_health_check=[HealthCheck.function_scoped_fixture])
+
+
+def populate(db, monthly, fixed, transactions):
+    """ Replace the database contents, returning the rows as inserted. """
+    curs = db.cursor()
+    for table in ("transactions", "transaction_summaries",
+                  "monthly_expenses", "fixed_expenses"):
+        curs.execute("DELETE FROM %s" % table)
+
+    monthly_ids = []
+    for (i, (cost_per_item, num_items)) in enumerate(monthly):
+        curs.execute(
+            "INSERT INTO monthly_expenses (name, cost_per_item, "
+            "num_items_per_month) VALUES (?, ?, ?)",
+            ("monthly%d" % i, cost_per_item, num_items))
+        monthly_ids.append(curs.lastrowid)
+
+    fixed_ids = []
+    for (i, cost) in enumerate(fixed):
+        curs.execute(
+            "INSERT INTO fixed_expenses (name, cost) VALUES (?, ?)",
+            ("fixed%d" % i, cost))
+        fixed_ids.append(curs.lastrowid)
+
+    rows = []
+    for (i, (cost, kind, index, day)) in enumerate(transactions):
+        monthly_id = fixed_id = None
+        if kind == "monthly" and monthly_ids:
+            monthly_id = monthly_ids[index % len(monthly_ids)]
+        elif kind == "fixed" and fixed_ids:
+            fixed_id = fixed_ids[index % len(fixed_ids)]
+
+        time = START + datetime.timedelta(days=day, minutes=i)
+        curs.execute(
+            budget.INSERT_TRANSACTION_SQL,
+            ("t%d" % i, cost, monthly_id, fixed_id, time, False))
+        rows.append({"cost": cost, "monthly_id": monthly_id,
+                     "fixed_id": fixed_id, "time": time})
+
+    db.commit()
+    curs.close()
+
+    return (dict(zip(monthly_ids, monthly)), dict(zip(fixed_ids, fixed)),
+            rows)
+
+
+def reference_totals(monthly, fixed, rows):
+    # get_totals interpolates num_months into its SQL with %d.
+    months = int(budget.current_settings.num_months)
+    allocated = sum(c * n * months for (c, n) in monthly.values())
+    allocated += sum(fixed.values())
+    return {
+        "sum_spent": sum(r["cost"] for r in rows),
+        "allocated_per_period": allocated,
+    }
+
+
+def reference_spent(rows, key, category_id):
+    costs = [r["cost"] for r in rows if r[key] == category_id]
+    return sum(costs) if costs else None
+
+
+def check_against_reference(db, monthly, fixed, rows):
+    t = budget.get_totals(db)
+    expected = reference_totals(monthly, fixed, rows)
+    assert t["sum_spent"] == expected["sum_spent"]
+    assert t["allocated_per_period"] == expected["allocated_per_period"]
+
+    listed = budget.list_monthly_expenses(db)
+    assert sorted(d["id"] for d in listed) == sorted(monthly)
+    per_year = [d["total_per_year"] for d in listed]
+    assert per_year == sorted(per_year, reverse=True)
+    for d in listed:
+        (cost_per_item, num_items) = monthly[d["id"]]
+        spent = reference_spent(rows, "monthly_id", d["id"]) or 0
+        assert d["spent"] == spent
+        assert d["total_per_month"] == cost_per_item * num_items
+        assert d["percent_spent"] == "%.2f%%" % (
+            spent / (cost_per_item * num_items * 12) * 100)
+
+    listed = budget.list_fixed_expenses(db)
+    assert sorted(d["id"] for d in listed) == sorted(fixed)
+    for d in listed:
+        assert d["fixed_cost"] == fixed[d["id"]]
+        assert d["spent"] == reference_spent(rows, "fixed_id", d["id"])
+
+
+@examples
+@given(monthly_st, fixed_st, transactions_st)
+def test_aggregates_match_reference(db, monthly, fixed, transactions):
+    (monthly, fixed, rows) = populate(db, monthly, fixed, transactions)
+    check_against_reference(db, monthly, fixed, rows)
+
+
+@examples
+@given(monthly_st, fixed_st, transactions_st, st.integers(0, 365),
+       st.sampled_from(["archive.db", "archive.ndjson.gz"]))
+def test_archive_keeps_aggregates(db, paths, monkeypatch, monthly, fixed,
+                                  transactions, before_day, archive_name):
+    archive = paths / archive_name
+    budget.detach_archive(db)
+    if archive.exists():
+        archive.unlink()
+    monkeypatch.setattr(budget, "archive_path", str(archive))
+
+    (monthly, fixed, rows) = populate(db, monthly, fixed, transactions)
+    before = (START + datetime.timedelta(days=before_day)).date()
+
+    num_archived = budget.archive_transactions(db, before)
+
+    assert num_archived == sum(1 for r in rows if r["time"].date() < before)
+    check_against_reference(db, monthly, fixed, rows)
+    assert len(budget.list_transactions(db, count=None)) == \
+        len(rows) - num_archived
+    assert len(budget.list_transactions(db, count=None, archived=True)) == \
+        len(rows)
+
+
+@pytest.mark.parametrize("archive_name", ["archive.db", "archive.ndjson.gz"])
+def test_listing_archived_does_not_create_archive(db, paths, monkeypatch,
+                                                  archive_name):
+    archive = paths / archive_name
+    monkeypatch.setattr(budget, "archive_path", str(archive))
+    populate(db, [], [], [(5, None, 0, 0)])
+
+    assert len(budget.list_transactions(db, archived=True)) == 1
+    assert not archive.exists()
+
+
+@pytest.mark.parametrize("archive_name", ["archive.db", "archive.ndjson.gz"])
+def test_failed_archive_can_be_retried(db, paths, monkeypatch, archive_name):
+    monkeypatch.setattr(budget, "archive_path", str(paths / archive_name))
+    populate(db, [], [], [(5, None, 0, 0), (6, None, 0, 1), (7, None, 0, 9)])
+    before = datetime.date(2018, 1, 5)
+
+    db.execute("""
+        CREATE TEMP TRIGGER fail_delete BEFORE DELETE ON main.transactions
+        BEGIN SELECT RAISE(ABORT, 'disk full'); END
+    """)
+    with pytest.raises(sqlite3.IntegrityError):
+        budget.archive_transactions(db, before)
+    db.execute("DROP TRIGGER temp.fail_delete")
+
+    # Copied to the archive but still live: listed once, counted once.
+    assert len(budget.list_transactions(db, archived=True)) == 3
+    assert budget.get_totals(db)["sum_spent"] == 18
+
+    assert budget.archive_transactions(db, before) == 2
+    assert len(budget.list_transactions(db)) == 1
+    assert len(budget.list_transactions(db, archived=True)) == 3
+    assert budget.get_totals(db)["sum_spent"] == 18
+
+
+def test_failed_ndjson_append_leaves_archive_intact(paths, monkeypatch):
+    archive = paths / "archive.ndjson.gz"
+    monkeypatch.setattr(budget, "archive_path", str(archive))
+    row = dict(zip(budget.TRANSACTION_COLUMNS,
+                   (1, "t", None, None, 5, "2018-01-01", 0)))
+    budget._append_ndjson_archive([row])
+    size = archive.stat().st_size
+
+    def failing_rows():
+        yield dict(row, id=2)
+        raise OSError("disk full")
+
+    with pytest.raises(OSError):
+        budget._append_ndjson_archive(failing_rows())
+
+    assert archive.stat().st_size == size
+    with gzip.open(str(archive), "rt") as f:
+        assert len(f.readlines()) == 1
+
+
+def test_settings_reload_only_on_change(paths, monkeypatch):
+    reads = []
+    read_settings = budget._read_settings
+    monkeypatch.setattr(budget, "_read_settings",
+                        lambda mtime: reads.append(1) or read_settings(mtime))
+
+    budget.load_settings()
+    assert reads == []
+
+    salary = budget.take_home_salary
+    write_settings(budget.settings_path, salary=104000)
+    mtime = os.stat(budget.settings_path).st_mtime + 1
+    os.utime(budget.settings_path, (mtime, mtime))
+
+    budget.load_settings()
+    assert reads == [1]
+    assert budget.take_home_salary == salary * 2
+
+
+def test_bad_settings_keep_last_good_values(paths):
+    salary = budget.take_home_salary
+
+    with open(budget.settings_path, "w") as f:
+        f.write('{"salary": 52000,')
+    mtime = os.stat(budget.settings_path).st_mtime + 1
+    os.utime(budget.settings_path, (mtime, mtime))
+
+    budget.load_settings()
+    assert budget.take_home_salary == salary
+
+    os.remove(budget.settings_path)
+    budget.load_settings()
+    assert budget.take_home_salary == salary
+
+    write_settings(budget.settings_path, salary=104000)
+    budget.load_settings()
+    assert budget.take_home_salary == salary * 2
+
+
+def test_bad_settings_raise_on_first_load(paths, monkeypatch):
+    monkeypatch.setattr(budget, "current_settings", None)
+    with open(budget.settings_path, "w") as f:
+        f.write('{"salary": 52000,')
+
+    with pytest.raises(ValueError):
+        budget.load_settings()
+
+
+def test_batch_writer_groups_concurrent_writes(db):
+    writer = BatchWriter(batch_size=16, delay_ms=5)
+
+    # Hold the first flush until other writers have queued behind it.
+    release = threading.Event()
+    batch_sizes = []
+    commit = writer._commit
+
+    def blocking_commit(conn, batch):
+        batch_sizes.append(len(batch))
+        release.wait()
+        commit(conn, batch)
+
+    writer._commit = blocking_commit
+
+    def worker(n):
+        conn = budget.get_db_connection()
+        for i in range(25):
+            writer.add_transaction(conn, 1, "w%d-%d" % (n, i))
+        conn.close()
+
+    threads = [threading.Thread(target=worker, args=(n,)) for n in range(8)]
+    for t in threads:
+        t.start()
+
+    # Every writer is blocked once its row is either in the held batch or
+    # queued behind it.
+    deadline = time.monotonic() + 5
+    while time.monotonic() < deadline and (
+            not batch_sizes or
+            batch_sizes[0] + writer._queue.qsize() < len(threads)):
+        time.sleep(0.001)
+    release.set()
+
+    for t in threads:
+        t.join()
+
+    assert budget.get_totals(db)["sum_spent"] == 200
+    assert sum(batch_sizes) == 200
+    assert len(batch_sizes) < 200
+    assert max(batch_sizes) > 1
@@ -0,0 +1,39 @@
+import datetime
+import os
+import sqlite3
+import subprocess
+import sys
+
+import budget
+from conftest import budget_dir, write_settings
+
+
+def run_cli(home, *args):
+    env = dict(os.environ, HOME=str(home))
+    return subprocess.run(
+        [sys.executable, os.path.join(budget_dir, "budget.py")] + list(args),
+        env=env, capture_output=True, text=True, check=True).stdout
+
+
+def test_list_includes_archived(tmp_path):
+    write_settings(str(tmp_path / "cdbudget.config.json"))
+    run_cli(tmp_path, "totals")
+
+    db = sqlite3.connect(str(tmp_path / "cdbudget.db"))
+    for (i, day) in enumerate((1, 2, 5)):
+        db.execute(
+            budget.INSERT_TRANSACTION_SQL,
+            ("t%d" % i, 10 + i, None, None, datetime.datetime(2018, 1, day),
+             False))
+    db.commit()
+    db.close()
+
+    out = run_cli(tmp_path, "archive", "--before", "2018-01-03")
+    assert "Archived 2 transactions" in out
+
+    out = run_cli(tmp_path, "list")
+    assert "t2" in out and "t0" not in out
+
+    out = run_cli(tmp_path, "list", "--archived")
+    assert all(name in out for name in ("t0", "t1", "t2"))
+    assert "$10" in out and "[None]" in out
@@ -0,0 +1,106 @@
+import json
+import os
+
+import pytest
+
+import budget
+import web
+
+
+@pytest.fixture
+def client(db):
+    budget.create_monthly_category("food", 10, 4)
+    budget.create_fixed_category("rent", 500)
+
+    app = web.create_app()
+    app.config["TESTING"] = True
+    return app.test_client()
+
+
+def read_event(events):
+    chunk = next(events).decode()
+    assert chunk.startswith("data: ")
+    return json.loads(chunk[len("data: "):])
+
+
+def test_dashboard_renders(client):
+    resp = client.get("/")
+    assert resp.status_code == 200
+    assert b'data-monthly="1"' in resp.data
+    assert b'data-fixed="1"' in resp.data
+
+
+def test_bad_settings_edit_keeps_serving(client, db):
+    with open(budget.settings_path, "w") as f:
+        f.write('{"salary": 52000,')
+    mtime = os.stat(budget.settings_path).st_mtime + 1
+    os.utime(budget.settings_path, (mtime, mtime))
+
+    assert client.get("/").status_code == 200
+    assert budget.current_settings.mtime == os.stat(
+        budget.settings_path).st_mtime_ns
+    resp = client.post("/transaction/monthly/add",
+                       data={"category": "food", "name": "x", "cost": "7"})
+    assert resp.status_code == 302
+    assert budget.get_totals(db)["sum_spent"] == 7
+
+
+def test_add_redirects_to_dashboard(client, db):
+    resp = client.post("/transaction/monthly/add",
+                       data={"category": "food", "name": "x", "cost": "7"})
+    assert resp.status_code == 302
+    assert resp.headers["Location"].endswith("/#add-m-t")
+    assert budget.get_totals(db)["sum_spent"] == 7
+
+
+def test_fetch_add_returns_no_content(client, db):
+    resp = client.post("/transaction/fixed/add",
+                       data={"category": "rent", "name": "y", "cost": "3"},
+                       headers={"X-Requested-With": "fetch"})
+    assert resp.status_code == 204
+    assert budget.list_fixed_expenses(db)[0]["spent"] == 3
+
+
+def test_events_push_only_changes(client):
+    events = iter(client.get("/events").response)
+
+    assert next(events) == b"retry: %d\n\n" % web.EVENTS_RETRY_MS
+    state = read_event(events)
+    assert state["transactions"] == []
+    assert state["totals"]["sum_spent"] == "$0"
+    assert state["monthly"]["1"]["spent_fmt"] == "$0"
+
+    client.post("/transaction/monthly/add",
+                data={"category": "food", "name": "x", "cost": "7"},
+                headers={"X-Requested-With": "fetch"})
+
+    delta = read_event(events)
+    assert delta["totals"]["sum_spent"] == "$7"
+    assert delta["monthly"]["1"]["spent_fmt"] == "$7"
+    assert delta["transactions"] == [["x", "food (Monthly)", "$7"]]
+    assert "fixed" not in delta
+
+
+def test_events_capped_per_process(db, monkeypatch):
+    monkeypatch.setattr(web, "EVENTS_MAX_STREAMS", 1)
+    client = web.create_app().test_client()
+
+    first = iter(client.get("/events").response)
+    next(first)
+
+    busy = list(client.get("/events").response)
+    assert busy == [b"retry: %d\n\n" % web.EVENTS_BUSY_RETRY_MS]
+
+    first.close()
+    second = iter(client.get("/events").response)
+    assert next(second) == b"retry: %d\n\n" % web.EVENTS_RETRY_MS
+
+
+def test_list_transactions_includes_archived(client, db):
+    for cost in (1, 2):
+        client.post("/transaction/monthly/add",
+                    data={"category": "food", "name": "x", "cost": cost})
+    budget.archive_transactions(db, "9999-01-01")
+
+    assert client.get("/transaction").data.count(b"Monthly") == 0
+    assert client.get("/transaction?archived").data.count(b"Monthly") == 2